@@ -1,18 +1,26 @@
 import os
 import logging
 import asyncio
+import concurrent.futures
+import functools
+import hashlib
 import io
+import queue
 import re
-from datetime import datetime, timedelta
-import requests
-import google.generativeai as genai
+from datetime import datetime, timedelta, timezone
+import aiosqlite
+import httpx
+from cachetools import LRUCache, TTLCache
+from google import genai
+from google.genai import errors as genai_errors
 from telegram import Update, InputFile, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import RetryAfter
 from telegram.ext import (ApplicationBuilder, CommandHandler, MessageHandler,
                           ContextTypes, filters, CallbackQueryHandler)
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import A4
-from reportlab.lib.utils import simpleSplit
 from reportlab.lib import colors
+from reportlab.pdfbase.pdfmetrics import stringWidth
 from PyPDF2 import PdfReader, PdfWriter
 
 # === Load API Keys ===
@@ -21,108 +29,229 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 PRODUCT_SECRET_KEY = os.getenv("PRODUCT_SECRET_KEY")
 
 # === Configure Gemini ===
-genai.configure(api_key=GEMINI_API_KEY)
+client = genai.Client(api_key=GEMINI_API_KEY)
 
-user_essay_data = {}
-user_license_status = {}
+# Transient per-user results; an entry only needs to outlive the PDF
+# button, so a bounded TTL cache keeps memory flat as user ids grow.
+user_essay_data = TTLCache(maxsize=10_000, ttl=3600)
 logging.basicConfig(level=logging.INFO)
 
+# === Compiled patterns (built once, reused per essay) ===
+_BAND_RE = re.compile(
+    r"(task achievement|vocabulary|grammatical range(?: and| &)? accuracy"
+    r"|coherence(?: and| &)? cohesion)[:\-\s]*([\d\.]+)\s*[-–]\s*([^\n]*)",
+    re.IGNORECASE)
+_CANONICAL_LABELS = {
+    "task achievement": "Task Achievement",
+    "vocabulary": "Vocabulary",
+    "grammatical range and accuracy": "Grammatical Range & Accuracy",
+    "grammatical range & accuracy": "Grammatical Range & Accuracy",
+    "grammatical range accuracy": "Grammatical Range & Accuracy",
+    "coherence and cohesion": "Coherence & Cohesion",
+    "coherence & cohesion": "Coherence & Cohesion",
+    "coherence cohesion": "Coherence & Cohesion",
+}
+_SENTENCE_RE = re.compile(r"[.!?]")
+_OVERALL_LINE_RE = re.compile(r"^overall", re.IGNORECASE)
+_OVERALL_STRIP_RE = re.compile(r"^overall(?: impression)?[:\-\s]*",
+                               re.IGNORECASE)
+_LIKELY_SCORE_RE = re.compile(r"This essay would likely score.*?(?:\\.|$)",
+                              re.IGNORECASE)
+_FALLBACK_RE = re.compile(
+    r"coherence(?: and| &)? cohesion[:\-\s]*[\d\.]+.*?\n\n(.*)",
+    re.IGNORECASE | re.DOTALL)
+
 
 # === AI Feedback Generation ===
-def generate_feedback_sync(essay: str) -> str:
+CRITERIA = ("Task Achievement", "Vocabulary", "Grammatical Range & Accuracy",
+            "Coherence & Cohesion")
+
+# Cap concurrent Gemini requests so a burst of essays stays under quota.
+_GEMINI_SEM = asyncio.Semaphore(5)
+_GEMINI_MAX_ATTEMPTS = 6
+
+# Users often resend the same essay (edits, retries); identical prompts
+# are answered from cache without spending latency or quota.
+_FEEDBACK_CACHE = LRUCache(maxsize=2048)
+
+
+async def _generate(prompt: str) -> str:
+    cache_key = hashlib.sha256(prompt.encode()).digest()
+    cached = _FEEDBACK_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+    async with _GEMINI_SEM:
+        for attempt in range(_GEMINI_MAX_ATTEMPTS):
+            try:
+                response = await client.aio.models.generate_content(
+                    model="gemini-2.0-flash", contents=prompt)
+                # response.text is None when the reply has no text parts
+                # (e.g. safety-blocked); coerce so callers always get a
+                # string and empty results are never cached.
+                text = response.text or ""
+                if text:
+                    _FEEDBACK_CACHE[cache_key] = text
+                return text
+            except genai_errors.APIError as e:
+                # Retry only quota (429) and server-side (5xx) failures.
+                if e.code != 429 and e.code < 500:
+                    raise
+                if attempt == _GEMINI_MAX_ATTEMPTS - 1:
+                    raise
+                delay = 10 * (2**attempt)
+                print(f"[Gemini] {e.code} on attempt {attempt + 1}, "
+                      f"retrying in {delay}s")
+                await asyncio.sleep(delay)
+
+
+async def score_one(essay: str, criterion: str) -> str:
     prompt = f"""
-You are an IELTS examiner. Evaluate the following essay using the 4 IELTS writing criteria:
-- Task Achievement
-- Vocabulary
-- Grammatical Range & Accuracy
-- Coherence & Cohesion
+You are an IELTS examiner. Evaluate the following essay on one IELTS writing criterion only: {criterion}.
 
-Return the band score and one-sentence comment for each component on a separate line, like:
-Task Achievement: 7 - Good understanding but lacks detail.
-Vocabulary: 8 - Rich vocabulary with only a few inaccuracies.
-Grammatical Range & Accuracy: 7 - Some errors affect clarity.
-Coherence & Cohesion: 8 - Well structured with logical flow.
-Remember that the band score should be a whole number not half number for each component. Give some mistake examples in the comment.
+Return the band score and one-sentence comment on a single line, like:
+{criterion}: 7 - Good understanding but lacks detail.
+Remember that the band score should be a whole number not half number. Give some mistake examples in the comment.
 
-Then give a brief overall impression summarizing the band scores and comments. Note : Do not include the band prediction sentence and avoid AI biased assessment.
+Essay:
+{essay}
+"""
+    try:
+        return await _generate(prompt)
+    except Exception as e:
+        print(f"Error from Gemini ({criterion}): {e}")
+        return ""
+
+
+async def overall_comment(essay: str, criterion_lines: list) -> str:
+    scored = "\n".join(criterion_lines)
+    prompt = f"""
+You are an IELTS examiner. Given the essay and the per-criterion band scores below, give a brief overall impression summarizing the band scores and comments, starting with "Overall:". Note : Do not include the band prediction sentence and avoid AI biased assessment.
+
+Scores:
+{scored}
 
 Essay:
 {essay}
 """
     try:
-        model = genai.GenerativeModel("gemini-2.0-flash")
-        response = model.generate_content(prompt)
-        return response.text
+        return await _generate(prompt)
     except Exception as e:
-        print(f"Error from Gemini: {e}")
-        return "❌ Sorry, something went wrong while analyzing your essay."
+        print(f"Error from Gemini (overall): {e}")
+        return ""
 
 
 def extract_band_details(text: str):
-    criteria = {
-        "Task Achievement":
-        r"task achievement[:\-\s]*([\d\.]+)\s*[-–]\s*(.*?)\n",
-        "Vocabulary":
-        r"vocabulary[:\-\s]*([\d\.]+)\s*[-–]\s*(.*?)\n",
-        "Grammatical Range & Accuracy":
-        r"grammatical range(?: and| &)? accuracy[:\-\s]*([\d\.]+)\s*[-–]\s*(.*?)\n",
-        "Coherence & Cohesion":
-        r"coherence(?: and| &)? cohesion[:\-\s]*([\d\.]+)\s*[-–]\s*(.*?)\n"
-    }
     summary = "📊 *Band Score Breakdown:*\n\n"
     comments = {}
     scores = []
-    for label, pattern in criteria.items():
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            band = float(match.group(1))
-            comment = match.group(2).strip()
+    for match in _BAND_RE.finditer(text):
+        label = _CANONICAL_LABELS[" ".join(match.group(1).lower().split())]
+        if label in comments:
+            continue
+        band = float(match.group(2))
+        comment = match.group(3).strip()
+        comments[label] = (band, comment)
+    for label in CRITERIA:
+        if label in comments:
+            band, comment = comments[label]
             scores.append(band)
-            comments[label] = (band, comment)
             summary += f"*{label}*: {band}\n💬 {comment}\n\n"
+    overall_score = None
     if scores:
-        overall = round(sum(scores) / len(scores) * 2) / 2
-        summary += f"*Overall Band Score*: {overall}"
+        overall_score = round(sum(scores) / len(scores) * 2) / 2
+        summary += f"*Overall Band Score*: {overall_score}"
     else:
         summary += "_Band scores not found._"
-    return summary.strip(), comments
+    return summary.strip(), comments, overall_score
 
 
 def extract_overall_comment(text: str) -> str:
     lines = text.splitlines()
     for line in lines:
-        if re.match(r"(?i)^overall", line.strip()):
-            cleaned = re.sub(r"(?i)^overall(?: impression)?[:\-\s]*", "",
-                             line).strip()
-            cleaned = re.sub(r"This essay would likely score.*?(?:\\.|$)",
-                             "",
-                             cleaned,
-                             flags=re.IGNORECASE).strip()
+        if _OVERALL_LINE_RE.match(line.strip()):
+            cleaned = _OVERALL_STRIP_RE.sub("", line).strip()
+            cleaned = _LIKELY_SCORE_RE.sub("", cleaned).strip()
             if len(cleaned.split()) >= 5:
                 return cleaned
 
-    fallback = re.search(
-        r"coherence(?: and| &)? cohesion[:\-\s]*[\d\.]+.*?\n\n(.*)", text,
-        re.IGNORECASE | re.DOTALL)
+    fallback = _FALLBACK_RE.search(text)
     if fallback:
         paragraph = fallback.group(1).strip().split("\n")[0]
-        cleaned = re.sub(r"This essay would likely score.*?(?:\\.|$)",
-                         "",
-                         paragraph,
-                         flags=re.IGNORECASE).strip()
+        cleaned = _LIKELY_SCORE_RE.sub("", paragraph).strip()
         return cleaned
 
     return "_No overall comment found._"
 
 
-used_licenses = {}  # In-memory store
+# Licensing state and essay counts live in SQLite so they survive
+# restarts and do not grow in RAM with the user base.
+_DB_PATH = os.getenv("LICENSE_DB_PATH", "licenses.db")
+
+
+async def _init_db():
+    async with aiosqlite.connect(_DB_PATH) as db:
+        await db.execute("CREATE TABLE IF NOT EXISTS licenses "
+                         "(user_id INTEGER PRIMARY KEY, "
+                         "license_key TEXT UNIQUE, expiry TEXT)")
+        await db.execute("CREATE TABLE IF NOT EXISTS essay_counts "
+                         "(user_id INTEGER PRIMARY KEY, "
+                         "count INTEGER NOT NULL)")
+        await db.commit()
+
+
+async def _get_license_expiry(user_id):
+    async with aiosqlite.connect(_DB_PATH) as db:
+        async with db.execute("SELECT expiry FROM licenses WHERE user_id = ?",
+                              (user_id, )) as cursor:
+            row = await cursor.fetchone()
+    return datetime.fromisoformat(row[0]) if row else None
+
+
+async def _license_owner(key):
+    async with aiosqlite.connect(_DB_PATH) as db:
+        async with db.execute(
+                "SELECT user_id FROM licenses WHERE license_key = ?",
+            (key, )) as cursor:
+            row = await cursor.fetchone()
+    return row[0] if row else None
 
 
-def check_license_validity(user_id, key):
+async def _save_license(user_id, key, expiry):
+    async with aiosqlite.connect(_DB_PATH) as db:
+        await db.execute(
+            "INSERT OR REPLACE INTO licenses (user_id, license_key, expiry) "
+            "VALUES (?, ?, ?)", (user_id, key, expiry.isoformat()))
+        await db.commit()
+
+
+async def _get_essay_count(user_id):
+    async with aiosqlite.connect(_DB_PATH) as db:
+        async with db.execute("SELECT count FROM essay_counts WHERE user_id = ?",
+                              (user_id, )) as cursor:
+            row = await cursor.fetchone()
+    return row[0] if row else 0
+
+
+async def _bump_essay_count(user_id):
+    async with aiosqlite.connect(_DB_PATH) as db:
+        await db.execute(
+            "INSERT INTO essay_counts (user_id, count) VALUES (?, 1) "
+            "ON CONFLICT(user_id) DO UPDATE SET count = count + 1",
+            (user_id, ))
+        await db.commit()
+
+
+# One pooled async client keeps the TLS connection to Payhip alive
+# across license checks and frees the event loop while a check is in
+# flight, instead of blocking it with a synchronous requests call.
+_PAYHIP = httpx.AsyncClient(
+    timeout=10.0, headers={"product-secret-key": PRODUCT_SECRET_KEY})
+
+
+async def check_license_validity(key):
     url = f"https://payhip.com/api/v2/license/verify?license_key={key}"
-    headers = {"product-secret-key": PRODUCT_SECRET_KEY}
     try:
-        response = requests.get(url, headers=headers, timeout=10)
+        response = await _PAYHIP.get(url)
         if response.status_code != 200:
             print(f"[Payhip] Status code: {response.status_code}")
             return False, None
@@ -130,16 +259,9 @@ def check_license_validity(user_id, key):
         data = response.json()
         print(f"[Payhip] Response JSON: {data}")
 
-        # If already used by a different user
-        if key in used_licenses and used_licenses[key] != user_id:
-            print(f"[Payhip] License already used by another user.")
-            return False, None
-
-        # Accept only if the key has 0 uses and not bound to another user
+        # Accept only if the key has 0 uses
         if "data" in data and data["data"].get("uses", -1) == 0:
-            expiry = datetime.now() + timedelta(days=30)
-            user_license_status[user_id] = {"expiry": expiry}
-            used_licenses[key] = user_id  # Bind license to user
+            expiry = datetime.now(timezone.utc) + timedelta(days=30)
             return True, expiry
         else:
             print(f"[Payhip] License is invalid or already used.")
@@ -151,12 +273,59 @@ def check_license_validity(user_id, key):
 
 
 # === PDF generation ===
-def generate_pdf_with_template(comments_dict: dict,
-                               overall: str) -> io.BytesIO:
-    buffer = io.BytesIO()
+# Read the report template once at import; each request parses the
+# in-memory bytes instead of re-reading PDF.pdf from disk.
+with open("PDF.pdf", "rb") as _template_file:
+    _TEMPLATE_BYTES = _template_file.read()
+
+# Recycled overlay buffers: a reused BytesIO keeps its grown backing
+# store, so later reports skip the realloc-as-it-grows churn.
+_PDF_BUFFERS = queue.SimpleQueue()
+
+class _ByteSink:
+    """Write-only file object backed by a bytearray, so PdfWriter appends
+    straight into one growable buffer instead of a third BytesIO."""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, b):
+        self.data += b
+        return len(b)
+
+    def tell(self):
+        return len(self.data)
+
+
+_FONT = "Helvetica"
+
+
+@functools.lru_cache(maxsize=1024)
+def _wrap(text: str, max_width: float, size: int):
+    """Word-wrap text to max_width points, memoized per (text, width, size)."""
+    lines = []
+    current = ""
+    for word in text.split():
+        candidate = f"{current} {word}" if current else word
+        if stringWidth(candidate, _FONT, size) <= max_width:
+            current = candidate
+        else:
+            if current:
+                lines.append(current)
+            current = word
+    if current:
+        lines.append(current)
+    return tuple(lines)
+
+
+def generate_pdf_with_template(comments_dict: dict, overall: str,
+                               overall_score: float) -> bytes:
     width, height = A4
 
-    packet = io.BytesIO()
+    try:
+        packet = _PDF_BUFFERS.get_nowait()
+    except queue.Empty:
+        packet = io.BytesIO()
     c = canvas.Canvas(packet, pagesize=A4)
     c.setFont("Helvetica", 10)
 
@@ -175,51 +344,114 @@ def generate_pdf_with_template(comments_dict: dict,
         c.drawRightString(width - 60, y - 20, f"Band: {score}")
 
         c.setFont("Helvetica", 9)
-        comment_lines = simpleSplit(comment, "Helvetica", 9, box_width - 20)
+        comment_lines = _wrap(comment, box_width - 20, 9)
         text = c.beginText(60, y - 35)
-        for line in comment_lines[:3]:
-            text.textLine(line)
+        text.textLines("\n".join(comment_lines[:3]))
         c.drawText(text)
 
         y -= box_height + 20
 
-    overall_score = round(
-        sum(score for score, _ in comments_dict.values()) /
-        len(comments_dict) * 2) / 2
     c.setFont("Helvetica-Bold", 11)
     c.drawString(50, y - 10, f"Overall Band Score: {overall_score}")
     c.setFont("Helvetica", 9)
-    overall_lines = simpleSplit(overall, "Helvetica", 9, box_width)
+    overall_lines = _wrap(overall, box_width, 9)
     text = c.beginText(50, y - 30)
-    for line in overall_lines[:5]:
-        text.textLine(line)
+    text.textLines("\n".join(overall_lines[:5]))
     c.drawText(text)
 
     c.save()
     packet.seek(0)
 
     overlay_pdf = PdfReader(packet)
-    template_pdf = PdfReader("PDF.pdf")
+    template_pdf = PdfReader(io.BytesIO(_TEMPLATE_BYTES))
     writer = PdfWriter()
     page = template_pdf.pages[0]
     page.merge_page(overlay_pdf.pages[0])
     writer.add_page(page)
 
-    final = io.BytesIO()
-    writer.write(final)
-    final.seek(0)
-    return final
+    sink = _ByteSink()
+    writer.write(sink)
+
+    packet.seek(0)
+    packet.truncate(0)
+    _PDF_BUFFERS.put(packet)
+    return bytes(sink.data)
+
+
+def _render_pdf(comments_dict: dict, overall: str,
+                overall_score: float) -> bytes:
+    # Runs in a worker process; returns bytes so nothing unpicklable
+    # crosses the process boundary.
+    return generate_pdf_with_template(comments_dict, overall, overall_score)
+
+
+# ReportLab drawing and the PyPDF2 merge are pure-Python CPU work, so
+# they run in worker processes instead of blocking the event loop.
+_PDF_EXECUTOR = concurrent.futures.ProcessPoolExecutor(max_workers=2)
+
+
+# === Outgoing message rate limiter ===
+class TGSender:
+    """Funnels every outbound Telegram call through one token-bucket queue
+    so the bot stays under the 30 msg/s bot-wide limit and survives 429s."""
+
+    def __init__(self, rate: int = 30):
+        self._queue = asyncio.Queue()
+        self._rate = rate
+
+    async def send(self, coro_factory):
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((coro_factory, fut))
+        return await fut
+
+    async def worker(self):
+        loop = asyncio.get_running_loop()
+        tokens = self._rate
+        window_start = loop.time()
+        while True:
+            coro_factory, fut = await self._queue.get()
+            now = loop.time()
+            if now - window_start >= 1.0:
+                tokens = self._rate
+                window_start = now
+            if tokens == 0:
+                await asyncio.sleep(window_start + 1.0 - now)
+                tokens = self._rate
+                window_start = loop.time()
+            tokens -= 1
+            try:
+                result = await coro_factory()
+            except RetryAfter as e:
+                print(f"[Telegram] Flood limit hit, pausing {e.retry_after}s")
+                await asyncio.sleep(e.retry_after)
+                await self._queue.put((coro_factory, fut))
+            except Exception as e:
+                fut.set_exception(e)
+            else:
+                fut.set_result(result)
+
+
+sender = TGSender()
+
+
+async def _post_init(app):
+    await _init_db()
+    app.create_task(sender.worker())
+
+
+async def _post_shutdown(app):
+    await _PAYHIP.aclose()
 
 
 # === Telegram Bot Handlers ===
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
+    await sender.send(lambda: update.message.reply_text(
         "👋 Send your IELTS essay and I’ll analyze it and return: band scores, comments, and optionally a PDF report.\nLimit: 3 free essays."
-    )
+    ))
 
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
+    await sender.send(lambda: update.message.reply_text(
         "ℹ️ *How to Use the Bot:*\n\n"
         "1. Send your IELTS essay text.\n"
         "2. Receive feedback, band scores, and word count.\n"
@@ -228,48 +460,104 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "🔑 Already purchased? Use /redeem <key>\n"
         "🛍️ Buy here: https://payhip.com/b/IGJcD\n\n"
         "💬 *Need help?* Contact @LexiBand",
-        parse_mode="Markdown")
+        parse_mode="Markdown"))
+
+
+# Messages rejected before reaching Gemini; they cost no quota.
+_invalid_count = 0
 
 
 async def handle_essay(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global _invalid_count
     user_id = update.message.from_user.id
     essay = update.message.text.strip()
     word_count = len(essay.split())
-    count = user_essay_data.get(user_id, {}).get("count", 0)
+
+    # Don't spend a Gemini round-trip (or free-tier quota) on input that
+    # can't be a real essay.
+    reason = None
+    if word_count < 50:
+        reason = "✍️ Please send a complete IELTS essay of at least 50 words."
+    elif word_count > 1000:
+        reason = "✍️ Please keep your essay under 1000 words."
+    elif not _SENTENCE_RE.search(essay):
+        reason = "✍️ That doesn't look like an essay — please send full sentences."
+    if reason:
+        _invalid_count += 1
+        print(f"[Validate] Rejected message with {word_count} words "
+              f"(total rejected: {_invalid_count})")
+        await sender.send(lambda: update.message.reply_text(reason))
+        return
+
+    count = await _get_essay_count(user_id)
 
     # Check if licensed user
-    expiry = user_license_status.get(user_id, {}).get("expiry")
-    is_licensed = expiry and expiry > datetime.datetime.now()
+    expiry = await _get_license_expiry(user_id)
+    is_licensed = expiry and expiry > datetime.now(timezone.utc)
 
     if count >= 3 and not is_licensed:
-        await update.message.reply_text(
+        await sender.send(lambda: update.message.reply_text(
             "🚫 You’ve reached your free limit. Buy a license key here: https://payhip.com/b/IGJcD"
-        )
+        ))
         return
 
-    await update.message.reply_text(
-        f"✍️ Analyzing your essay... (Words: {word_count})")
-    feedback = await asyncio.to_thread(generate_feedback_sync, essay)
-    summary, comments = extract_band_details(feedback)
-    overall = extract_overall_comment(feedback)
-
+    await sender.send(lambda: update.message.reply_text(
+        f"✍️ Analyzing your essay... (Words: {word_count})"))
+    criterion_lines = await asyncio.gather(
+        *(score_one(essay, criterion) for criterion in CRITERIA))
+    criterion_lines = [line.strip() for line in criterion_lines if line]
+    feedback = "\n".join(criterion_lines) + "\n"
+    summary, comments, overall_score = extract_band_details(feedback)
+    overall = extract_overall_comment(await overall_comment(
+        essay, criterion_lines))
+
+    await _bump_essay_count(user_id)
+    # Only what the PDF button needs is cached; the raw feedback would
+    # pin the full Gemini response text in memory for no reader.
     user_essay_data[user_id] = {
-        "count": count + 1,
-        "feedback": feedback,
-        "summary": summary,
         "comments": comments,
-        "overall": overall
+        "overall": overall,
+        "overall_score": overall_score
     }
 
+    if is_licensed and comments:
+        # Licensed users always want the report, so attach it to the
+        # summary itself: one outbound message instead of summary +
+        # button + document, halving rate-limit pressure. The render
+        # starts in the pool while the caption is formatted.
+        pdf_future = asyncio.get_running_loop().run_in_executor(
+            _PDF_EXECUTOR, _render_pdf, comments, overall, overall_score)
+        caption = f"{summary}\n\n📝 *Overall*: {overall}"
+        pdf_bytes = await pdf_future
+        if len(caption) <= 1024:
+            await sender.send(lambda: update.message.reply_document(
+                document=InputFile(io.BytesIO(pdf_bytes),
+                                   filename="IELTS_Feedback.pdf"),
+                caption=caption,
+                parse_mode="Markdown"))
+        else:
+            # Too long for a Telegram caption; truncating mid-entity
+            # would make the whole message fail to parse, so send the
+            # report with a short caption and the full summary as its
+            # own message (still one fewer than the button flow).
+            await sender.send(lambda: update.message.reply_document(
+                document=InputFile(io.BytesIO(pdf_bytes),
+                                   filename="IELTS_Feedback.pdf"),
+                caption="📄 Your IELTS feedback report"))
+            await sender.send(lambda: update.message.reply_text(
+                caption, parse_mode="Markdown"))
+        return
+
     keyboard = [[
         InlineKeyboardButton("📄 Create PDF Report",
                              callback_data="generate_pdf")
     ]]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    await update.message.reply_text(f"{summary}\n\n📝 *Overall*: {overall}",
-                                    parse_mode="Markdown",
-                                    reply_markup=reply_markup)
+    await sender.send(
+        lambda: update.message.reply_text(f"{summary}\n\n📝 *Overall*: {overall}",
+                                          parse_mode="Markdown",
+                                          reply_markup=reply_markup))
 
 
 async def handle_pdf_request(update: Update,
@@ -279,49 +567,62 @@ async def handle_pdf_request(update: Update,
     user_id = query.from_user.id
 
     if user_id not in user_essay_data:
-        await query.edit_message_text("❌ No essay data found.")
+        await sender.send(
+            lambda: query.edit_message_text("❌ No essay data found."))
         return
 
     data = user_essay_data[user_id]
-    pdf_file = generate_pdf_with_template(data["comments"], data["overall"])
-    await query.message.reply_document(
-        document=InputFile(pdf_file, filename="IELTS_Feedback.pdf"))
+    pdf_bytes = await asyncio.get_running_loop().run_in_executor(
+        _PDF_EXECUTOR, _render_pdf, data["comments"], data["overall"],
+        data["overall_score"])
+    await sender.send(lambda: query.message.reply_document(
+        document=InputFile(io.BytesIO(pdf_bytes),
+                           filename="IELTS_Feedback.pdf")))
 
 
 async def handle_redeem(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     parts = update.message.text.strip().split()
     if len(parts) != 2:
-        await update.message.reply_text("❌ Usage: /redeem <LICENSE_KEY>")
+        await sender.send(
+            lambda: update.message.reply_text("❌ Usage: /redeem <LICENSE_KEY>"))
         return
 
     key = parts[1]
-    valid, expiry = check_license_validity(user_id, key)
+    owner = await _license_owner(key)
+    if owner is not None and owner != user_id:
+        print("[Payhip] License already used by another user.")
+        await sender.send(lambda: update.message.reply_text(
+            "❌ Invalid or already-used license key."))
+        return
+
+    valid, expiry = await check_license_validity(key)
 
     if valid:
-        await update.message.reply_text(
-            f"✅ License activated! Expires on {expiry.strftime('%Y-%m-%d')}")
+        await _save_license(user_id, key, expiry)
+        await sender.send(lambda: update.message.reply_text(
+            f"✅ License activated! Expires on {expiry.strftime('%Y-%m-%d')}"))
     else:
-        await update.message.reply_text(
-            "❌ Invalid or already-used license key.")
+        await sender.send(lambda: update.message.reply_text(
+            "❌ Invalid or already-used license key."))
 
 
 async def handle_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    status = user_license_status.get(user_id)
-    if status:
-        expiry = status["expiry"].strftime('%Y-%m-%d')
-        await update.message.reply_text(
-            f"🔓 Your license is active until {expiry}.")
+    expiry = await _get_license_expiry(user_id)
+    if expiry:
+        await sender.send(lambda: update.message.reply_text(
+            f"🔓 Your license is active until {expiry.strftime('%Y-%m-%d')}."))
     else:
-        await update.message.reply_text(
+        await sender.send(lambda: update.message.reply_text(
             "🔒 You are using the free version. Use /redeem to activate a license."
-        )
+        ))
 
 
 # === Entrypoint ===
 def main():
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    app = ApplicationBuilder().token(TELEGRAM_TOKEN).post_init(
+        _post_init).post_shutdown(_post_shutdown).build()
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("redeem", handle_redeem))
     app.add_handler(CommandHandler("status", handle_status))
@@ -0,0 +1,66 @@
+import asyncio
+import os
+from datetime import datetime, timedelta, timezone
+
+os.environ.setdefault("TELEGRAM_TOKEN", "test-token")
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+os.environ.setdefault("PRODUCT_SECRET_KEY", "test-secret")
+
+import main
+
+
+def _use_tmp_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "_DB_PATH", str(tmp_path / "licenses.db"))
+
+
+def test_active_license_passes_expiry_check(tmp_path, monkeypatch):
+    _use_tmp_db(tmp_path, monkeypatch)
+
+    async def scenario():
+        await main._init_db()
+        expiry = datetime.now(timezone.utc) + timedelta(days=30)
+        await main._save_license(1, "KEY-ACTIVE", expiry)
+        stored = await main._get_license_expiry(1)
+        assert stored == expiry
+        # The is_licensed comparison from handle_essay.
+        assert stored > datetime.now(timezone.utc)
+        assert await main._license_owner("KEY-ACTIVE") == 1
+
+    asyncio.run(scenario())
+
+
+def test_expired_license_fails_expiry_check(tmp_path, monkeypatch):
+    _use_tmp_db(tmp_path, monkeypatch)
+
+    async def scenario():
+        await main._init_db()
+        expiry = datetime.now(timezone.utc) - timedelta(days=1)
+        await main._save_license(2, "KEY-EXPIRED", expiry)
+        stored = await main._get_license_expiry(2)
+        assert not (stored and stored > datetime.now(timezone.utc))
+
+    asyncio.run(scenario())
+
+
+def test_unknown_user_has_no_expiry(tmp_path, monkeypatch):
+    _use_tmp_db(tmp_path, monkeypatch)
+
+    async def scenario():
+        await main._init_db()
+        assert await main._get_license_expiry(999) is None
+
+    asyncio.run(scenario())
+
+
+def test_extract_band_details_parses_scores():
+    feedback = (
+        "Task Achievement: 7 - Good understanding but lacks detail.\n"
+        "Vocabulary: 8 - Rich vocabulary with few inaccuracies.\n"
+        "Grammatical Range & Accuracy: 7 - Some errors affect clarity.\n"
+        "Coherence and Cohesion: 8 - Well structured with logical flow.\n")
+    summary, comments, overall_score = main.extract_band_details(feedback)
+    assert set(comments) == set(main.CRITERIA)
+    assert comments["Task Achievement"] == (7.0,
+                                            "Good understanding but lacks detail.")
+    assert overall_score == 7.5
+    assert "*Overall Band Score*: 7.5" in summary